@@ -11,6 +11,8 @@ import json
 from py_smsify import SmsMessage
 import datetime
 import logging
+import threading
+import re
 
 app = Flask(__name__)
 twilio_client = Client(os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN'))
@@ -48,7 +50,57 @@ logging.basicConfig(
 
 logger = logging.getLogger(SCRIPT_NAME)
 
-def extract_answers(serp_message):
+# Admission control configuration
+RATE_LIMIT_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', '6'))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '3'))
+MAX_INFLIGHT = int(os.getenv('MAX_INFLIGHT', '8'))
+SKIP_LOOKUPS_AT = float(os.getenv('SKIP_LOOKUPS_AT', '0.5'))
+CHEAP_MODEL_AT = float(os.getenv('CHEAP_MODEL_AT', '0.75'))
+REPLY_MODEL = os.getenv('REPLY_MODEL', 'gpt-4')
+CHEAP_REPLY_MODEL = os.getenv('CHEAP_REPLY_MODEL', 'gpt-3.5-turbo')
+BUSY_REPLY = os.getenv('BUSY_REPLY', "Sorry, I'm swamped right now, please text me again in a minute.")
+
+# Degradation levels, in the order they are applied as load increases
+LEVEL_NORMAL = 0
+LEVEL_SKIP_LOOKUPS = 1
+LEVEL_CHEAP_MODEL = 2
+LEVEL_BUSY = 3
+
+admission_lock = threading.Lock()
+rate_buckets = {}
+last_bucket_sweep = 0.0
+inflight = 0
+admission_stats = {
+    'admitted': 0,
+    'rate_limited': 0,
+    'skipped_lookups': 0,
+    'cheap_model': 0,
+    'busy_replies': 0,
+}
+
+# Prefetch configuration. Prefetching makes recurring paid SERP and OpenAI calls, so it is off
+# unless PREFETCH_ENABLED is set. Each run makes at most PREFETCH_MAX_CALLS_PER_RUN of those calls.
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'false').lower() == 'true'
+PREFETCH_INTERVAL_MINUTES = int(os.getenv('PREFETCH_INTERVAL_MINUTES', '15'))
+PREFETCH_FRESHNESS_MINUTES = int(os.getenv('PREFETCH_FRESHNESS_MINUTES', '30'))
+PREFETCH_LOOKBACK_HOURS = int(os.getenv('PREFETCH_LOOKBACK_HOURS', '72'))
+PREFETCH_MIN_ASKS = int(os.getenv('PREFETCH_MIN_ASKS', '3'))
+PREFETCH_MAX_CALLS_PER_RUN = int(os.getenv('PREFETCH_MAX_CALLS_PER_RUN', '30'))
+PREFETCH_EXTRACT_ATTEMPTS = int(os.getenv('PREFETCH_EXTRACT_ATTEMPTS', '2'))
+PREFETCH_INJECT_LIMIT = int(os.getenv('PREFETCH_INJECT_LIMIT', '5'))
+
+# Words dropped when turning a question into a template, so rewordings of the same question match
+TEMPLATE_FILLER_WORDS = {
+    'a', 'an', 'the', 'is', 'are', 'what', 's', 'whats', 'current', 'currently', 'today', 'todays',
+    'now', 'right', 'in', 'at', 'for', 'of', 'on', 'please', 'me', 'tell', 'latest', 'like',
+}
+# Stands in for the words of the user's location in a question template
+TEMPLATE_LOCATION_TOKEN = '{loc}'
+
+prefetch_lock = threading.Lock()
+prefetch_thread = None
+
+def extract_answers(serp_message, max_attempts=6):
     """
     Extracts answers from the given SERP API output.
 
@@ -58,6 +110,7 @@ def extract_answers(serp_message):
 
     Args:
     - serp_message (Union[str, dict]): SERP API output, either as a JSON string or dictionary.
+    - max_attempts (int, optional): The most OpenAI API calls to make. Defaults to 6.
 
     Returns:
     - dict: A dictionary containing 'question' and 'answer'.
@@ -90,7 +143,7 @@ def extract_answers(serp_message):
         serp_message = json.dumps(serp_message)
 
     retry_count = 0
-    while retry_count < 6:
+    while retry_count < max_attempts:
 
         # Formulate the system and user messages for OpenAI API call
         message_pr = [
@@ -458,27 +511,358 @@ def validate_user_and_get_assistant(from_number):
     return user, assistant
 
 
-def gather_info(message, user):
+def take_token(from_number):
+    """Takes a token from the phone number's rate limit bucket.
+
+    Each phone number gets a token bucket holding up to RATE_LIMIT_BURST tokens,
+    refilled at RATE_LIMIT_PER_MINUTE tokens per minute. Buckets left untouched
+    long enough to refill completely are dropped, since a new bucket starts full.
+
+    Args:
+        from_number: The user's phone number.
+
+    Returns:
+        True if a token was available, False if the number is rate limited.
+    """
+    global last_bucket_sweep
+
+    now = time.monotonic()
+    refill_seconds = RATE_LIMIT_BURST * 60.0 / RATE_LIMIT_PER_MINUTE
+    with admission_lock:
+        if now - last_bucket_sweep >= refill_seconds:
+            for number, (_, last_refill) in list(rate_buckets.items()):
+                if now - last_refill >= refill_seconds:
+                    del rate_buckets[number]
+            last_bucket_sweep = now
+
+        tokens, last_refill = rate_buckets.get(from_number, (RATE_LIMIT_BURST, now))
+        tokens = min(RATE_LIMIT_BURST, tokens + (now - last_refill) * RATE_LIMIT_PER_MINUTE / 60.0)
+
+        if tokens < 1:
+            rate_buckets[from_number] = (tokens, now)
+            admission_stats['rate_limited'] += 1
+            return False
+
+        rate_buckets[from_number] = (tokens - 1, now)
+        return True
+
+
+def acquire_slot():
+    """Claims an in-flight slot and picks a degradation level for the request.
+
+    The level depends on how full the global in-flight cap is: past SKIP_LOOKUPS_AT
+    the SERP lookups are skipped, past CHEAP_MODEL_AT the cheaper reply model is used
+    as well, and at MAX_INFLIGHT no slot is claimed and a canned busy reply is sent.
+
+    Returns:
+        The degradation level. A slot is only held (and must be released with
+        release_slot) when the level is below LEVEL_BUSY.
+    """
+    global inflight
+
+    with admission_lock:
+        if inflight >= MAX_INFLIGHT:
+            admission_stats['busy_replies'] += 1
+            return LEVEL_BUSY
+
+        load = inflight / MAX_INFLIGHT
+        inflight += 1
+        admission_stats['admitted'] += 1
+
+        if load >= CHEAP_MODEL_AT:
+            admission_stats['skipped_lookups'] += 1
+            admission_stats['cheap_model'] += 1
+            return LEVEL_CHEAP_MODEL
+        if load >= SKIP_LOOKUPS_AT:
+            admission_stats['skipped_lookups'] += 1
+            return LEVEL_SKIP_LOOKUPS
+        return LEVEL_NORMAL
+
+
+def release_slot():
+    """Releases an in-flight slot claimed by acquire_slot."""
+    global inflight
+
+    with admission_lock:
+        inflight -= 1
+
+
+def question_template(question, location):
+    """
+    Reduces a question to a template so differently worded versions of it match.
+
+    The question is casefolded and stripped of punctuation and filler words, and each run of words
+    from the user's location is replaced by a single location token. Word order is kept, so
+    "Flights from Vancouver to Toronto" and "Flights from Toronto to Vancouver" stay different.
+    For example, "What's the weather in Vancouver today?" and "What is the current weather in
+    Vancouver, Canada" both become "weather {loc}".
+
+    Args:
+    - question (str): A question returned by extract_questions.
+    - location (str): The user's location.
+
+    Returns:
+    - str: The question template, or an empty string if nothing is left.
+    """
+    location_words = set(re.sub(r'[^\w\s]', ' ', (location or '').casefold()).split())
+    words = re.sub(r'[^\w\s]', ' ', question.casefold()).split()
+
+    template_words = []
+    for word in words:
+        if word in location_words:
+            word = TEMPLATE_LOCATION_TOKEN
+            if template_words and template_words[-1] == word:
+                continue
+        elif word in TEMPLATE_FILLER_WORDS:
+            continue
+        template_words.append(word)
+
+    return ' '.join(template_words)[:255]
+
+
+def has_answer(extracted):
+    """
+    Checks whether an extract_answers result holds a real answer.
+
+    Args:
+    - extracted (Union[str, dict]): The result of extract_answers.
+
+    Returns:
+    - bool: True if the result parses and its 'answer' is not missing or 'None'.
+    """
+    if isinstance(extracted, str):
+        try:
+            extracted = json.loads(extracted)
+        except json.JSONDecodeError:
+            return False
+
+    if not isinstance(extracted, dict):
+        return False
+
+    answer = extracted.get('answer')
+    return answer is not None and str(answer).strip() not in ('', 'None')
+
+
+def save_questions(user, questions_list):
+    """
+    Saves the questions extracted from a user's message so the prefetcher can find popular ones.
+
+    Args:
+    - user (dict): The user data.
+    - questions_list (list): The questions returned by extract_questions.
+    """
+
+    try:
+        with get_db().cursor() as cursor:
+            for question in questions_list:
+                if not isinstance(question, str):
+                    continue
+                template = question_template(question, user['location'])
+                if template:
+                    cursor.execute('INSERT INTO user_questions (user_id, question, template) VALUES (%s, %s, %s)',
+                                   (user['id'], question.strip()[:255], template))
+            get_db().commit()
+
+    except Exception as e:
+        logger.error(f"Error saving questions for user ID {user['id']}: {e}")
+        if VERBOSE:
+            print(f"Error saving questions for user ID {user['id']}: {e}")
+
+
+def get_prefetched_answers(user, templates=None):
+    """
+    Fetches the fresh prefetched answers for the user's location, country and language.
+
+    Args:
+    - user (dict): The user data.
+    - templates (list, optional): Only fetch answers for these question templates. Defaults to None,
+      which fetches the PREFETCH_INJECT_LIMIT most asked answers.
+
+    Returns:
+    - list: A list of dicts with 'template' and 'answer', most asked first.
+    """
+
+    query = (
+        'SELECT template, answer FROM prefetched_answers '
+        'WHERE location = %s AND country = %s AND languages = %s '
+        'AND refreshed_at >= NOW() - INTERVAL %s MINUTE '
+    )
+    params = [user['location'], user['country'], user['languages'], PREFETCH_FRESHNESS_MINUTES]
+
+    if templates is None:
+        query += 'ORDER BY asks DESC LIMIT %s'
+        params.append(PREFETCH_INJECT_LIMIT)
+    elif not templates:
+        return []
+    else:
+        query += 'AND template IN (' + ', '.join(['%s'] * len(templates)) + ') ORDER BY asks DESC'
+        params.extend(templates)
+
+    try:
+        with get_db().cursor() as cursor:
+            cursor.execute(query, params)
+            return [row for row in cursor.fetchall() if has_answer(row['answer'])]
+
+    except Exception as e:
+        logger.error(f"Error retrieving prefetched answers for user ID {user['id']}: {e}")
+        if VERBOSE:
+            print(f"Error retrieving prefetched answers for user ID {user['id']}: {e}")
+        return []
+
+
+def prefetch_popular_questions():
+    """
+    Refreshes the answers to the most asked questions per location before users ask them.
+
+    Questions saved by save_questions within the last PREFETCH_LOOKBACK_HOURS are grouped by template
+    and by the asking user's location, country and language. Templates asked by at least
+    PREFETCH_MIN_ASKS different users that were not attempted within PREFETCH_FRESHNESS_MINUTES are
+    looked up again, most asked first. Each lookup costs one SERP call plus up to
+    PREFETCH_EXTRACT_ATTEMPTS OpenAI calls, and a run stops before it could go over
+    PREFETCH_MAX_CALLS_PER_RUN calls. Every attempt is recorded so unanswerable questions wait out
+    the freshness window, but only real answers are stored and marked refreshed. Questions older
+    than the lookback window are deleted.
+
+    Returns:
+    - int: The number of answers refreshed.
+    """
+
+    calls_per_lookup = 1 + PREFETCH_EXTRACT_ATTEMPTS
+    max_lookups = PREFETCH_MAX_CALLS_PER_RUN // calls_per_lookup
+    if max_lookups < 1:
+        return 0
+
+    with get_db().cursor() as cursor:
+        cursor.execute('DELETE FROM user_questions WHERE created_at < NOW() - INTERVAL %s HOUR',
+                       (PREFETCH_LOOKBACK_HOURS,))
+        get_db().commit()
+
+        cursor.execute(
+            'SELECT u.location, u.country, u.languages, q.template, MAX(q.question) AS question, '
+            'COUNT(DISTINCT q.user_id) AS asks '
+            'FROM user_questions q '
+            'JOIN users u ON u.id = q.user_id '
+            'LEFT JOIN prefetched_answers p ON p.location = u.location AND p.country = u.country '
+            'AND p.languages = u.languages AND p.template = q.template '
+            'WHERE q.created_at >= NOW() - INTERVAL %s HOUR '
+            'AND u.location IS NOT NULL AND u.languages IS NOT NULL '
+            'AND (p.attempted_at IS NULL OR p.attempted_at < NOW() - INTERVAL %s MINUTE) '
+            'GROUP BY u.location, u.country, u.languages, q.template '
+            'HAVING asks >= %s '
+            'ORDER BY asks DESC LIMIT %s',
+            (PREFETCH_LOOKBACK_HOURS, PREFETCH_FRESHNESS_MINUTES, PREFETCH_MIN_ASKS, max_lookups)
+        )
+        candidates = cursor.fetchall()
+
+    refreshed = 0
+    for row in candidates:
+        try:
+            answer = extract_answers(get_google_answer(row['question'], serp_key, location=row['location'], language=row['languages'], country=row['country']),
+                                     max_attempts=PREFETCH_EXTRACT_ATTEMPTS)
+        except Exception as e:
+            logger.error(f"Error prefetching '{row['question']}': {e}")
+            answer = None
+
+        key = (row['location'], row['country'], row['languages'], row['template'])
+
+        with get_db().cursor() as cursor:
+            if has_answer(answer):
+                cursor.execute(
+                    'INSERT INTO prefetched_answers (location, country, languages, template, question, answer, asks, refreshed_at, attempted_at) '
+                    'VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), NOW()) '
+                    'ON DUPLICATE KEY UPDATE question = VALUES(question), answer = VALUES(answer), asks = VALUES(asks), '
+                    'refreshed_at = NOW(), attempted_at = NOW()',
+                    key + (row['question'], answer, row['asks'])
+                )
+                refreshed += 1
+            else:
+                # Only record the attempt, a missing answer must not suppress live lookups
+                cursor.execute(
+                    'INSERT INTO prefetched_answers (location, country, languages, template, question, asks, refreshed_at, attempted_at) '
+                    'VALUES (%s, %s, %s, %s, %s, %s, NULL, NOW()) '
+                    'ON DUPLICATE KEY UPDATE asks = VALUES(asks), attempted_at = NOW()',
+                    key + (row['question'], row['asks'])
+                )
+            get_db().commit()
+
+    logger.info(f"Prefetched {refreshed} of {len(candidates)} popular questions.")
+    if VERBOSE:
+        print(f"Prefetched {refreshed} of {len(candidates)} popular questions.")
+
+    return refreshed
+
+
+def run_prefetcher():
+    """Runs prefetch_popular_questions every PREFETCH_INTERVAL_MINUTES, forever."""
+    while True:
+        try:
+            with app.app_context():
+                prefetch_popular_questions()
+        except Exception as e:
+            logger.error(f"Prefetch run failed: {e}")
+            if VERBOSE:
+                print(f"Prefetch run failed: {e}")
+
+        time.sleep(PREFETCH_INTERVAL_MINUTES * 60)
+
+
+@app.before_request
+def start_prefetcher():
+    """Starts the background prefetch thread in the serving process on the first request."""
+    global prefetch_thread
+
+    if not PREFETCH_ENABLED or prefetch_thread is not None:
+        return
+
+    with prefetch_lock:
+        if prefetch_thread is None:
+            prefetch_thread = threading.Thread(target=run_prefetcher, name='prefetcher', daemon=True)
+            prefetch_thread.start()
+
+
+def gather_info(message, user, skip_lookups=False):
     """Gathers relevant info based on the user's message.
 
+    Questions with a fresh prefetched answer for the user's location use it
+    instead of a lookup. When lookups are skipped, the most asked prefetched
+    answers for the location are included instead.
+
     Args:
         message: The user's message.
         user: The user data.
+        skip_lookups: If True, skip question extraction and SERP lookups.
 
     Returns:
         A tuple containing the gathered info and chat history.
     """
     try:
-        questions = extract_questions(message).replace("'", '"')
-        try:
-            questions_list = json.loads(questions)
-        except json.JSONDecodeError:
-            questions_list = None
         gathered_info = []
 
+        if skip_lookups:
+            questions_list = None
+            gathered_info = [row['answer'] for row in get_prefetched_answers(user)]
+        else:
+            questions = extract_questions(message).replace("'", '"')
+            try:
+                questions_list = json.loads(questions)
+            except json.JSONDecodeError:
+                questions_list = None
+
         if questions_list:
-            for question in questions_list:
+            save_questions(user, questions_list)
+
+            templates = [question_template(question, user['location']) if isinstance(question, str) else '' for question in questions_list]
+            prefetched = {row['template']: row['answer'] for row in get_prefetched_answers(user, [t for t in set(templates) if t])}
+
+            injected = set()
+
+            for question, template in zip(questions_list, templates):
                 question_value = question
+                if template in prefetched:
+                    if template not in injected:
+                        gathered_info.append(prefetched[template])
+                        injected.add(template)
+                    continue
                 gather = extract_answers(get_google_answer(question_value, serp_key, location=user['location'], language=user['languages'], country=user['country']))
                 gathered_info.append(gather)
 
@@ -572,12 +956,13 @@ def build_system_prompt(gathered_info, user, assistant):
     return system_prompt
 
 
-def generate_reply(messages, user):
+def generate_reply(messages, user, model=REPLY_MODEL):
     """Generates a reply using OpenAI's API.
 
     Args:
         messages: A list of messages.
         user: The user data.
+        model: The OpenAI model used to generate the reply.
 
     Returns:
         A string containing the reply.
@@ -588,7 +973,7 @@ def generate_reply(messages, user):
     for attempt in range(3):  # Retry up to 3 times
         try:
             response = openai.ChatCompletion.create(
-                model="gpt-4",
+                model=model,
                 messages=messages,
             )
             reply = response['choices'][0]['message']['content'].strip()
@@ -653,6 +1038,10 @@ def sms_reply():
     and uses OpenAI's API to generate a reply. The reply is sent
     back to the user via SMS.
 
+    Requests are rate limited per phone number and, as the number of
+    in-flight requests grows, degraded by skipping lookups, switching to
+    a cheaper reply model, and finally sending a canned busy reply.
+
     Returns:
         A tuple containing a string response and an HTTP status code.
     """
@@ -663,14 +1052,44 @@ def sms_reply():
         # Validate the user and get the corresponding assistant
         user, assistant = validate_user_and_get_assistant(from_number)
 
-        # Gather relevant info based on the user's message
-        gathered_info, history = gather_info(message, user)
+        # Unknown senders get the error response before using any admission capacity
+        if isinstance(assistant, int):
+            return user, assistant
+
+        # Keep the message but don't reply if this number is sending too fast
+        if not take_token(from_number):
+            logger.warning(f"Rate limited phone number: {from_number}")
+            if VERBOSE:
+                print(f"Rate limited phone number: {from_number}")
+            save_message(user['id'], 'user', message)
+            return str(MessagingResponse()), 200, {'Content-Type': 'application/xml'}
+
+        level = acquire_slot()
+
+        # Too many requests in flight, send a canned reply instead
+        if level == LEVEL_BUSY:
+            logger.warning(f"At in-flight cap, sending busy reply to: {from_number}")
+            if VERBOSE:
+                print(f"At in-flight cap, sending busy reply to: {from_number}")
+            save_message(user['id'], 'user', message)
+            send_reply(BUSY_REPLY, from_number)
+            return 'OK', 200
+
+        try:
+            if level > LEVEL_NORMAL:
+                logger.info(f"Degrading request from {from_number} to level {level}")
 
-        # Build a list of messages for the conversation
-        messages = build_messages(gathered_info, history, user, assistant, message)
+            # Gather relevant info based on the user's message
+            gathered_info, history = gather_info(message, user, skip_lookups=level >= LEVEL_SKIP_LOOKUPS)
 
-        # Use OpenAI's API to generate a reply
-        reply = generate_reply(messages, user)
+            # Build a list of messages for the conversation
+            messages = build_messages(gathered_info, history, user, assistant, message)
+
+            # Use OpenAI's API to generate a reply
+            model = CHEAP_REPLY_MODEL if level >= LEVEL_CHEAP_MODEL else REPLY_MODEL
+            reply = generate_reply(messages, user, model=model)
+        finally:
+            release_slot()
 
         # Send the reply to the user
         send_reply(reply, from_number)
@@ -681,5 +1100,23 @@ def sms_reply():
         return 'Internal Server Error', 500
 
 
+@app.route('/admission', methods=['GET'])
+def admission_status():
+    """Reports admission control counters to local requests only.
+
+    Returns:
+        A JSON string with the current in-flight count and the admitted,
+        rate limited, degraded and busy reply counts.
+    """
+    # Requests proxied by nginx carry X-Real-IP, so only direct local requests are allowed
+    if request.remote_addr not in ('127.0.0.1', '::1') or request.headers.get('X-Real-IP'):
+        return 'Forbidden', 403
+
+    with admission_lock:
+        status = dict(admission_stats, inflight=inflight, max_inflight=MAX_INFLIGHT)
+
+    return json.dumps(status), 200, {'Content-Type': 'application/json'}
+
+
 if __name__ == "__main__":
     app.run(debug=True)
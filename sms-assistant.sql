@@ -40,6 +40,29 @@ CREATE TABLE `assistants` (
 ) ENGINE=InnoDB AUTO_INCREMENT=11 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `prefetched_answers`
+--
+
+DROP TABLE IF EXISTS `prefetched_answers`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `prefetched_answers` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `location` varchar(128) COLLATE utf8mb4_unicode_ci NOT NULL COMMENT 'The User location the answer was looked up for.',
+  `country` varchar(4) COLLATE utf8mb4_unicode_ci NOT NULL COMMENT 'The User country the answer was looked up for.',
+  `languages` varchar(4) COLLATE utf8mb4_unicode_ci NOT NULL COMMENT 'The User language the answer was looked up for.',
+  `template` varchar(255) COLLATE utf8mb4_unicode_ci NOT NULL COMMENT 'The normalized template of the popular question that was prefetched.',
+  `question` varchar(255) COLLATE utf8mb4_unicode_ci NOT NULL COMMENT 'The question text that was looked up for the template.',
+  `answer` text COLLATE utf8mb4_unicode_ci COMMENT 'The extracted question and answer JSON, ready to add to the system prompt.',
+  `asks` int NOT NULL DEFAULT '0' COMMENT 'How many Users asked the question in the lookback window when last refreshed.',
+  `refreshed_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP COMMENT 'Timestamp from when a real answer was last looked up.',
+  `attempted_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP COMMENT 'Timestamp from when the answer was last looked up, with or without a result.',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `location_template` (`location`,`country`,`languages`,`template`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `user_history`
 --
@@ -60,6 +83,27 @@ CREATE TABLE `user_history` (
 ) ENGINE=InnoDB AUTO_INCREMENT=1078 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `user_questions`
+--
+
+DROP TABLE IF EXISTS `user_questions`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `user_questions` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `user_id` int NOT NULL,
+  `question` varchar(255) COLLATE utf8mb4_unicode_ci NOT NULL COMMENT 'A search question extracted from a User message.',
+  `template` varchar(255) COLLATE utf8mb4_unicode_ci NOT NULL COMMENT 'The question without its location, punctuation and filler words, used to find popular questions.',
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `user_id` (`user_id`),
+  KEY `created_at` (`created_at`),
+  KEY `template` (`template`),
+  CONSTRAINT `user_questions_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `users`
 --